@@ -7,16 +7,39 @@ This file handles app initialization and middleware configuration.
 Routes are defined in routes.py, models in responses.py.
 """
 
+import os
+from contextlib import asynccontextmanager
+
+import anyio.to_thread
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
 
+from responses import ORJSONResponse
 from routes import health_router, router
+from tools import close_gemini_client, shutdown_pdf_pool
+
+# Worker threads available for blocking work (PDF extraction) off the event loop
+THREAD_LIMIT = 64
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Configure shared resources on startup and release them on shutdown."""
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREAD_LIMIT
+    yield
+    shutdown_pdf_pool()
+    await close_gemini_client()
+
 
 # Initialize FastAPI app
 app = FastAPI(
     title="The Knowledge Extractor",
     description="Extract knowledge from PDFs and generate study materials",
     version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # Configure CORS for frontend development
@@ -26,8 +49,34 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,  # Let browsers reuse preflight results for 24 hours
+)
+
+# Compress JSON bodies (flashcards, quiz) for clients that accept gzip. The
+# NDJSON flashcard stream is left alone so gzip does not buffer its cards.
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=500,
+    exclude_content_types=DEFAULT_EXCLUDED_CONTENT_TYPES + ("application/x-ndjson",),
 )
 
 # Include routers
 app.include_router(health_router)
 app.include_router(router)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # A single worker by default: the result caches and request coalescing in
+    # tools.py are per-process, so extra workers only help shared deployments.
+    # Workers inherit WEB_CONCURRENCY, which tools.py uses to split its limits.
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run(
+        "main:app",
+        host="127.0.0.1",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+    )
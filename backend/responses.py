@@ -1,12 +1,21 @@
 """
-Pydantic models for API request/response validation.
+Pydantic models for API request/response validation, and the JSON response class.
 """
 
-from typing import List
+from typing import Any, List
 
+import orjson
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
 
+class ORJSONResponse(JSONResponse):
+    """JSON response serialized with orjson."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+
 class FileInfo(BaseModel):
     """PDF file metadata."""
 
@@ -29,6 +38,13 @@ class QuizQuestion(BaseModel):
     correct_index: int
 
 
+class StudyMaterials(BaseModel):
+    """Flashcards and quiz generated together from the same documents."""
+
+    flashcards: List[Flashcard]
+    quiz: List[QuizQuestion]
+
+
 class QuizAnswer(BaseModel):
     """A submitted quiz answer."""
 
@@ -2,24 +2,81 @@
 API route handlers for The Knowledge Extractor.
 """
 
-from typing import List
+import hashlib
+from typing import Any, AsyncIterator, List
 
-from fastapi import APIRouter, HTTPException
+import orjson
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 
-from responses import FileInfo, Flashcard, QuizQuestion, QuizSubmission, GradedAnswer
+from responses import (
+    FileInfo,
+    Flashcard,
+    QuizQuestion,
+    StudyMaterials,
+    QuizSubmission,
+    GradedAnswer,
+    ORJSONResponse,
+)
 from tools import (
+    RateLimitedError,
     get_pdf_files,
     scan_all_pdfs,
+    generate_study_materials_with_gemini,
     generate_flashcards_with_gemini,
+    stream_flashcards_with_gemini,
     generate_quiz_with_gemini,
     grade_quiz_with_gemini,
 )
 
+# Generated items are already validated in tools.py, so the Gemini-backed
+# routes return them as JSON responses directly. The response_model on each
+# route still documents the schema but skips re-validating every item.
+
 # Create router instances
 router = APIRouter(prefix="/api", tags=["api"])
 health_router = APIRouter(tags=["health"])
 
 
+def _rate_limited(e: RateLimitedError) -> HTTPException:
+    """Build the 429 response for a Gemini quota error."""
+    return HTTPException(
+        status_code=429,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """Check whether If-None-Match names this ETag (weak comparison, as for GET)."""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag in candidates or "*" in candidates
+
+
+def _conditional_json(request: Request, content: Any) -> Response:
+    """
+    Serialize content as JSON with an ETag, or answer 304 if the client has it.
+
+    Responses are marked no-cache so browsers always revalidate: changes show
+    up immediately, and unchanged content costs an empty 304.
+
+    The ETag is weak because GZipMiddleware may send the same JSON gzipped or
+    as-is; both encodings are equivalent but not byte-identical.
+    """
+    body = orjson.dumps(content)
+    etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    headers = {"ETag": f"W/{etag}", "Cache-Control": "no-cache"}
+    if _etag_matches(request, etag):
+        # GZipMiddleware adds Vary to full responses but skips bodiless ones
+        headers["Vary"] = "Accept-Encoding"
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
 @health_router.get("/health")
 async def health_check():
     """Health check endpoint to verify the server is running."""
@@ -27,17 +84,53 @@ async def health_check():
 
 
 @router.get("/files", response_model=List[FileInfo])
-async def get_files():
+async def get_files(request: Request):
     """Get list of PDF files in the documents folder."""
     pdf_files = get_pdf_files()
-    return [FileInfo(name=name, size=size) for name, size in pdf_files]
+    return _conditional_json(
+        request, [{"name": name, "size": size} for name, size in pdf_files]
+    )
+
+
+@router.get("/study-materials", response_model=StudyMaterials)
+async def get_study_materials(request: Request, fresh: bool = False):
+    """
+    Generate flashcards and a quiz from PDF content in a single Gemini call.
+
+    Pass fresh=1 to regenerate instead of reusing the cached materials.
+    """
+    # Get combined text from all PDFs
+    text = await run_in_threadpool(scan_all_pdfs)
+
+    if not text:
+        raise HTTPException(
+            status_code=404,
+            detail="No PDF documents found. Add PDFs to the ./documents folder.",
+        )
+
+    try:
+        materials = await generate_study_materials_with_gemini(text, fresh)
+        return _conditional_json(request, materials)
+    except RateLimitedError as e:
+        raise _rate_limited(e)
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to generate study materials: {str(e)}",
+        )
 
 
 @router.get("/flashcards", response_model=List[Flashcard])
-async def get_flashcards():
-    """Generate flashcards from PDF content using Gemini AI."""
+async def get_flashcards(request: Request, fresh: bool = False):
+    """
+    Generate flashcards from PDF content using Gemini AI.
+
+    Pass fresh=1 to regenerate instead of reusing the cached flashcards.
+    """
     # Get combined text from all PDFs
-    text = scan_all_pdfs()
+    text = await run_in_threadpool(scan_all_pdfs)
 
     if not text:
         raise HTTPException(
@@ -46,8 +139,10 @@ async def get_flashcards():
         )
 
     try:
-        flashcards_data = await generate_flashcards_with_gemini(text)
-        return [Flashcard(front=fc["front"], back=fc["back"]) for fc in flashcards_data]
+        flashcards_data = await generate_flashcards_with_gemini(text, fresh)
+        return _conditional_json(request, flashcards_data)
+    except RateLimitedError as e:
+        raise _rate_limited(e)
     except ValueError as e:
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
@@ -57,11 +152,59 @@ async def get_flashcards():
         )
 
 
+@router.get("/flashcards/stream")
+async def stream_flashcards(fresh: bool = False):
+    """
+    Stream flashcards as NDJSON, one card per line, as Gemini generates them.
+
+    Pass fresh=1 to regenerate instead of replaying the cached flashcards.
+    """
+    # Get combined text from all PDFs
+    text = await run_in_threadpool(scan_all_pdfs)
+
+    if not text:
+        raise HTTPException(
+            status_code=404,
+            detail="No PDF documents found. Add PDFs to the ./documents folder.",
+        )
+
+    # Wait for the first card so setup errors still get a proper status code
+    flashcards = stream_flashcards_with_gemini(text, fresh)
+    try:
+        first = await anext(flashcards)
+    except StopAsyncIteration:
+        raise HTTPException(status_code=500, detail="No valid flashcards generated")
+    except RateLimitedError as e:
+        raise _rate_limited(e)
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to generate flashcards: {str(e)}",
+        )
+
+    async def ndjson_lines() -> AsyncIterator[bytes]:
+        yield orjson.dumps(first) + b"\n"
+        try:
+            async for flashcard in flashcards:
+                yield orjson.dumps(flashcard) + b"\n"
+        except Exception as e:
+            # Headers are already sent; end the stream with the cards so far
+            print(f"Error streaming flashcards: {e}")
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+
 @router.get("/quiz", response_model=List[QuizQuestion])
-async def get_quiz():
-    """Generate quiz questions from PDF content using Gemini AI."""
+async def get_quiz(request: Request, fresh: bool = False):
+    """
+    Generate quiz questions from PDF content using Gemini AI.
+
+    Pass fresh=1 to regenerate instead of reusing the cached quiz.
+    """
     # Get combined text from all PDFs
-    text = scan_all_pdfs()
+    text = await run_in_threadpool(scan_all_pdfs)
 
     if not text:
         raise HTTPException(
@@ -70,15 +213,10 @@ async def get_quiz():
         )
 
     try:
-        quiz_data = await generate_quiz_with_gemini(text)
-        return [
-            QuizQuestion(
-                question=q["question"],
-                options=q["options"],
-                correct_index=q["correct_index"],
-            )
-            for q in quiz_data
-        ]
+        quiz_data = await generate_quiz_with_gemini(text, fresh)
+        return _conditional_json(request, quiz_data)
+    except RateLimitedError as e:
+        raise _rate_limited(e)
     except ValueError as e:
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
@@ -94,6 +232,13 @@ async def grade_quiz(submission: QuizSubmission):
     if not submission.answers:
         raise HTTPException(status_code=400, detail="No answers provided.")
 
+    # Feedback is matched back by question_index, so each must be unique
+    question_indices = {ans.question_index for ans in submission.answers}
+    if len(question_indices) != len(submission.answers):
+        raise HTTPException(
+            status_code=400, detail="Each question_index may only appear once."
+        )
+
     # Convert Pydantic models to dicts for the grading function
     answers_data = [
         {
@@ -108,14 +253,7 @@ async def grade_quiz(submission: QuizSubmission):
 
     try:
         graded_data = await grade_quiz_with_gemini(answers_data)
-        return [
-            GradedAnswer(
-                question_index=g["question_index"],
-                is_correct=g["is_correct"],
-                feedback=g["feedback"],
-            )
-            for g in graded_data
-        ]
+        return ORJSONResponse(graded_data)
     except ValueError as e:
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
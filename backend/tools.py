@@ -3,15 +3,35 @@ The Knowledge Extractor - Utility Functions
 PDF extraction, Gemini client, and helper functions.
 """
 
-import json
+import asyncio
+import hashlib
+import math
+import multiprocessing
 import os
-import re
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
 from pathlib import Path
-from typing import Any, List, Optional, Tuple
-
-import google.generativeai as genai
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import httpx
+import orjson
+import pymupdf
 from dotenv import load_dotenv
-from pypdf import PdfReader
+from cachetools import TTLCache
 
 # Load environment variables from .env file
 load_dotenv()
@@ -22,52 +42,408 @@ DOCUMENTS_PATH = Path(__file__).parent.parent / "documents"
 # Gemini configuration
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL = "gemini-2.0-flash"  # Current Gemini 3 Flash equivalent
-
-# Configure Gemini client
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/"
 
 # Text truncation limit to stay within token limits
 MAX_TEXT_CHARS = 15000
 
+# How long generated flashcards + quiz are reused for the same corpus,
+# and how many distinct corpora are remembered
+STUDY_MATERIALS_TTL_SECONDS = 600
+STUDY_MATERIALS_CACHE_SIZE = 32
+
+# Uvicorn worker processes serving the app (uvicorn reads the same variable).
+# Each worker has its own rate limiter, so the sustained Gemini rate is split
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
+# Client-side pacing for Gemini calls, to stay under the per-project quota
+GEMINI_MAX_CONCURRENCY = 4
+GEMINI_REQUESTS_PER_SECOND = 1.0
+GEMINI_BURST = 4
+GEMINI_MAX_ATTEMPTS = 3
+GEMINI_RETRY_BASE_SECONDS = 1.0
+
+# Gemini HTTP statuses worth retrying: quota exhaustion and transient server failures
+RETRYABLE_GEMINI_STATUSES = {429, 500, 503, 504}
+
+# Extracted PDF text, keyed by path and validated against (st_mtime_ns, st_size);
+# the third field is the char budget it was cut short at, or None if complete
+_pdf_text_cache: Dict[Path, Tuple[int, int, Optional[int], str]] = {}
+_pdf_text_locks: Dict[Path, threading.Lock] = {}
+_pdf_text_locks_guard = threading.Lock()
+
+# Worker processes for CPU-bound PDF parsing, created on first use
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+
+# Sorted PDF paths in DOCUMENTS_PATH, keyed by the directory's st_mtime_ns
+_pdf_listing: Optional[Tuple[int, List[Path]]] = None
+
+# Combined corpus text, keyed by the (name, size, mtime) listing it was built from
+_corpus_cache: Optional[Tuple[Tuple[Tuple[str, int, int], ...], str]] = None
+
+# Generated study materials, keyed by corpus hash (LRU with expiry)
+_study_materials_cache: TTLCache = TTLCache(
+    maxsize=STUDY_MATERIALS_CACHE_SIZE, ttl=STUDY_MATERIALS_TTL_SECONDS
+)
+
+# Gemini calls currently running, keyed by request hash, shared by identical callers
+_inflight: Dict[bytes, asyncio.Task] = {}
+# Streaming generations among those, so later streams can replay their cards
+_flashcard_broadcasts: Dict[bytes, "_FlashcardBroadcast"] = {}
+
+# Long-lived HTTP/2 client for the Gemini REST API, created on first use
+_gemini_client: Optional[httpx.AsyncClient] = None
+
+
+class RateLimitedError(Exception):
+    """Raised when Gemini keeps rejecting calls because the quota is exhausted."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
 
-def get_gemini_model() -> Optional[genai.GenerativeModel]:
+class _TokenBucket:
+    """Allows `rate` acquisitions per second on average, bursting up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.last_refill) * self.rate
+                )
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Burst and concurrency stay per worker so a lone request (or its retry) never
+# waits on sibling workers' share; only the long-run rate is divided among them
+_gemini_bucket = _TokenBucket(
+    GEMINI_REQUESTS_PER_SECOND / WEB_CONCURRENCY, GEMINI_BURST
+)
+_gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+
+def get_gemini_client() -> Optional[httpx.AsyncClient]:
     """
-    Get configured Gemini model instance.
+    Get the shared Gemini API client.
+
+    The client keeps HTTP/2 connections to the API alive between requests,
+    so calls after the first skip the TLS handshake.
 
     Returns:
-        GenerativeModel instance if API key is configured, None otherwise
+        AsyncClient instance if API key is configured, None otherwise
     """
+    global _gemini_client
     if not GEMINI_API_KEY:
         print("Warning: GEMINI_API_KEY not set in .env file")
         return None
 
-    return genai.GenerativeModel(GEMINI_MODEL)
-
-
-def extract_text_from_pdf(pdf_path: Path) -> str:
+    if _gemini_client is None:
+        _gemini_client = httpx.AsyncClient(
+            base_url=GEMINI_API_URL,
+            headers={"x-goog-api-key": GEMINI_API_KEY},
+            http2=True,
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=300),
+        )
+    return _gemini_client
+
+
+async def close_gemini_client() -> None:
+    """Close the shared Gemini API client, if it was created."""
+    global _gemini_client
+    if _gemini_client is not None:
+        await _gemini_client.aclose()
+        _gemini_client = None
+
+
+def _get_pdf_text_lock(pdf_path: Path) -> threading.Lock:
+    """Get the lock serializing extraction of a single PDF."""
+    with _pdf_text_locks_guard:
+        lock = _pdf_text_locks.get(pdf_path)
+        if lock is None:
+            lock = _pdf_text_locks[pdf_path] = threading.Lock()
+        return lock
+
+
+def _prune_pdf_text_cache(current_paths: Set[Path]) -> None:
+    """Forget cached text and locks for PDFs that are no longer listed."""
+    with _pdf_text_locks_guard:
+        for pdf_path in list(_pdf_text_cache):
+            if pdf_path not in current_paths:
+                _pdf_text_cache.pop(pdf_path, None)
+        for pdf_path, lock in list(_pdf_text_locks.items()):
+            # A held lock is still in use by an extraction of that path
+            if pdf_path not in current_paths and not lock.locked():
+                del _pdf_text_locks[pdf_path]
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    """Get the shared process pool used for PDF parsing, creating it if needed."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # Leave cores for the other uvicorn workers' pools
+            max_workers = max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)
+            # Never fork(): this process runs threads (anyio workers, HTTP client)
+            start_method = (
+                "forkserver"
+                if "forkserver" in multiprocessing.get_all_start_methods()
+                else "spawn"
+            )
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context(start_method),
+            )
+        return _pdf_pool
+
+
+def _discard_pdf_pool(pool: ProcessPoolExecutor) -> None:
+    """Drop a broken pool so the next call starts a new one."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        # Another thread may already have replaced it
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_pdf_pool() -> None:
+    """Stop the PDF worker processes, if they were started."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown(cancel_futures=True)
+            _pdf_pool = None
+
+
+def _read_pdf_text(pdf_path: Path, char_budget: Optional[int] = None) -> str:
     """
-    Extract all text content from a PDF file.
+    Parse a PDF file and extract the text of its pages.
+
+    Runs inside the PDF worker processes, so it must stay a top-level function.
 
     Args:
         pdf_path: Path to the PDF file
+        char_budget: Stop after the page that reaches this many characters;
+                     None extracts every page
 
     Returns:
-        Combined text from all pages, or empty string if extraction fails
+        Combined text from the extracted pages, or empty string if extraction fails
     """
     try:
-        reader = PdfReader(pdf_path)
-        text_parts = []
-        for page in reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text_parts.append(page_text)
+        with pymupdf.open(pdf_path) as doc:
+            text_parts = []
+            total = 0
+            for page in doc:
+                page_text = page.get_text()
+                if page_text:
+                    text_parts.append(page_text)
+                    total += len(page_text)
+                    if char_budget is not None and total >= char_budget:
+                        break
         return "\n\n".join(text_parts)
     except Exception as e:
         print(f"Error extracting text from {pdf_path}: {e}")
         return ""
 
 
+def _parse_pdfs(
+    pdf_paths: List[Path], char_budget: Optional[int]
+) -> List[Optional[str]]:
+    """
+    Parse PDFs in the worker process pool.
+
+    If the pool dies (for example a worker crashing in MuPDF on a malformed
+    file), it is replaced and the files are retried one at a time, so only
+    the file that crashes it is lost. Parsing never falls back to this
+    process, where the same crash would take down the server.
+
+    Returns:
+        Text for each path, in order; None where the file could not be parsed
+    """
+    budgets = [char_budget] * len(pdf_paths)
+    pool = _get_pdf_pool()
+    try:
+        return list(pool.map(_read_pdf_text, pdf_paths, budgets))
+    except BrokenProcessPool as e:
+        print(f"PDF worker pool failed, retrying files one at a time: {e}")
+        _discard_pdf_pool(pool)
+
+    texts: List[Optional[str]] = []
+    for pdf_path in pdf_paths:
+        pool = _get_pdf_pool()
+        try:
+            texts.append(pool.submit(_read_pdf_text, pdf_path, char_budget).result())
+        except BrokenProcessPool as e:
+            print(f"PDF worker pool failed on {pdf_path}, skipping it: {e}")
+            _discard_pdf_pool(pool)
+            texts.append(None)
+    return texts
+
+
+def _cached_pdf_text(
+    pdf_path: Path, signature: Tuple[int, int], char_budget: Optional[int]
+) -> Optional[str]:
+    """Return cached text for pdf_path if it is current and long enough."""
+    cached = _pdf_text_cache.get(pdf_path)
+    if not cached or cached[:2] != signature:
+        return None
+    cached_budget = cached[2]
+    if cached_budget is None or (
+        char_budget is not None and cached_budget >= char_budget
+    ):
+        return cached[3]
+    return None
+
+
+def extract_texts_from_pdfs(
+    pdf_paths: List[Path], char_budget: Optional[int] = None
+) -> List[str]:
+    """
+    Extract text content from several PDF files.
+
+    Results are cached in memory and reused until a file's modification
+    time or size changes. PDFs missing from the cache are parsed in
+    parallel across worker processes.
+
+    Args:
+        pdf_paths: Paths to the PDF files
+        char_budget: Characters needed from each file; pages past it are
+                     skipped. None extracts every page
+
+    Returns:
+        Text for each path, in order; empty string where extraction fails
+    """
+    return _extract_texts(pdf_paths, char_budget)[0]
+
+
+def _extract_texts(
+    pdf_paths: List[Path], char_budget: Optional[int]
+) -> Tuple[List[str], Set[Path]]:
+    """
+    Extract text from several PDF files, reporting which ones failed.
+
+    Same arguments and caching as extract_texts_from_pdfs.
+
+    Returns:
+        Tuple of (text for each path in order, paths that could not be read
+        or parsed). Failed paths get empty text and are not cached, so a
+        later call retries them
+    """
+    texts: Dict[Path, str] = {}
+    failed: Set[Path] = set()
+    signatures: Dict[Path, Tuple[int, int]] = {}
+    for pdf_path in pdf_paths:
+        try:
+            stat = pdf_path.stat()
+        except OSError as e:
+            print(f"Error extracting text from {pdf_path}: {e}")
+            texts[pdf_path] = ""
+            failed.add(pdf_path)
+            continue
+
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = _cached_pdf_text(pdf_path, signature, char_budget)
+        if cached is not None:
+            texts[pdf_path] = cached
+        else:
+            signatures[pdf_path] = signature
+
+    if signatures:
+        # Lock in sorted order so concurrent scans cannot deadlock
+        with ExitStack() as stack:
+            misses = []
+            for pdf_path in sorted(signatures):
+                stack.enter_context(_get_pdf_text_lock(pdf_path))
+                # Another request may have parsed it while we waited
+                cached = _cached_pdf_text(pdf_path, signatures[pdf_path], char_budget)
+                if cached is not None:
+                    texts[pdf_path] = cached
+                else:
+                    misses.append(pdf_path)
+
+            parsed = _parse_pdfs(misses, char_budget) if misses else []
+            for pdf_path, text in zip(misses, parsed):
+                if text is None:
+                    # Leave it uncached so a later scan can try again
+                    texts[pdf_path] = ""
+                    failed.add(pdf_path)
+                    continue
+                # Text shorter than the budget means every page was read
+                truncated_at = (
+                    char_budget
+                    if char_budget is not None and len(text) >= char_budget
+                    else None
+                )
+                _pdf_text_cache[pdf_path] = (*signatures[pdf_path], truncated_at, text)
+                texts[pdf_path] = text
+
+    return [texts[pdf_path] for pdf_path in pdf_paths], failed
+
+
+def extract_text_from_pdf(pdf_path: Path, char_budget: Optional[int] = None) -> str:
+    """
+    Extract text content from a PDF file.
+
+    Args:
+        pdf_path: Path to the PDF file
+        char_budget: Stop after the page that reaches this many characters;
+                     None extracts every page
+
+    Returns:
+        Combined text from the extracted pages, or empty string if extraction fails
+    """
+    return extract_texts_from_pdfs([pdf_path], char_budget)[0]
+
+
+def _list_pdf_paths() -> List[Path]:
+    """
+    List the PDFs in the documents folder, sorted by filename.
+
+    Adding, removing, or renaming a file bumps the directory's mtime, so the
+    listing is only rebuilt when that changes.
+
+    Returns:
+        Sorted list of PDF paths (empty if the folder is missing)
+    """
+    global _pdf_listing
+
+    try:
+        dir_mtime_ns = DOCUMENTS_PATH.stat().st_mtime_ns
+    except OSError:
+        return []
+
+    cached = _pdf_listing
+    if cached is not None and cached[0] == dir_mtime_ns:
+        return cached[1]
+
+    with os.scandir(DOCUMENTS_PATH) as entries:
+        names = sorted(
+            entry.name
+            for entry in entries
+            if entry.name.endswith(".pdf") and entry.is_file()
+        )
+    pdf_paths = [DOCUMENTS_PATH / name for name in names]
+
+    _pdf_listing = (dir_mtime_ns, pdf_paths)
+    return pdf_paths
+
+
 def get_pdf_files() -> List[Tuple[str, int]]:
     """
     Get list of PDF files in the documents folder.
@@ -75,38 +451,181 @@ def get_pdf_files() -> List[Tuple[str, int]]:
     Returns:
         List of tuples containing (filename, file_size_bytes)
     """
-    if not DOCUMENTS_PATH.exists():
-        return []
-
     pdf_files = []
-    for pdf_path in DOCUMENTS_PATH.glob("*.pdf"):
-        pdf_files.append((pdf_path.name, pdf_path.stat().st_size))
-
-    return sorted(pdf_files, key=lambda x: x[0])
+    # Sizes change without touching the directory, so always stat the files
+    for pdf_path in _list_pdf_paths():
+        try:
+            pdf_files.append((pdf_path.name, pdf_path.stat().st_size))
+        except OSError:
+            continue  # Removed since the listing
+    return pdf_files
 
 
 def scan_all_pdfs() -> str:
     """
     Scan all PDFs in the documents folder and combine their text.
 
+    The combined text is reused as long as no PDF has been added, removed,
+    or modified since the last scan.
+
     Returns:
         Combined text from all PDFs, separated by document markers
     """
-    if not DOCUMENTS_PATH.exists():
-        return ""
-
-    pdf_paths = list(DOCUMENTS_PATH.glob("*.pdf"))
+    global _corpus_cache
+
+    pdf_paths = []
+    signature = []
+    for pdf_path in _list_pdf_paths():
+        try:
+            stat = pdf_path.stat()
+        except OSError:
+            continue  # Removed since the listing
+        pdf_paths.append(pdf_path)
+        signature.append((pdf_path.name, stat.st_size, stat.st_mtime_ns))
     if not pdf_paths:
         return ""
 
+    cached = _corpus_cache
+    if cached and cached[0] == tuple(signature):
+        return cached[1]
+
+    # The listing changed; drop entries for PDFs that were deleted or renamed
+    _prune_pdf_text_cache(set(pdf_paths))
+
+    # Prompts only use the first MAX_TEXT_CHARS of the corpus, so no file
+    # needs more than that, and files past the point it is filled are dropped
+    texts, failed = _extract_texts(pdf_paths, char_budget=MAX_TEXT_CHARS)
     all_text_parts = []
-    for pdf_path in sorted(pdf_paths):
-        text = extract_text_from_pdf(pdf_path)
+    total = 0
+    for pdf_path, text in zip(pdf_paths, texts):
         if text:
             # Add document separator for clarity
             all_text_parts.append(f"--- Document: {pdf_path.name} ---\n{text}")
+            total += len(all_text_parts[-1]) + 2
+            if total > MAX_TEXT_CHARS:
+                break
+
+    corpus = "\n\n".join(all_text_parts)
+    if not failed:
+        # A corpus missing failed files must not outlive this request
+        _corpus_cache = (tuple(signature), corpus)
+    return corpus
 
-    return "\n\n".join(all_text_parts)
+
+async def _send_to_gemini(send: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Issue a Gemini request with client-side rate limiting and retries.
+
+    Each attempt takes a token from the shared bucket and runs under the
+    concurrency gate. Quota errors, transient server errors, and network
+    failures are retried with exponential backoff and jitter.
+
+    Args:
+        send: Issues the request, raising httpx.HTTPStatusError on error statuses
+
+    Returns:
+        Whatever send() returns
+
+    Raises:
+        RateLimitedError: If the quota is still exhausted after all attempts
+    """
+    for attempt in range(GEMINI_MAX_ATTEMPTS):
+        await _gemini_bucket.acquire()
+        try:
+            async with _gemini_semaphore:
+                return await send()
+        except (httpx.HTTPStatusError, httpx.TransportError) as e:
+            status = (
+                e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+            )
+            if status is not None and status not in RETRYABLE_GEMINI_STATUSES:
+                raise
+            delay = GEMINI_RETRY_BASE_SECONDS * 2**attempt * random.uniform(0.75, 1.25)
+            if attempt == GEMINI_MAX_ATTEMPTS - 1:
+                if status == 429:
+                    raise RateLimitedError(
+                        "Gemini rate limit reached. Please try again shortly.",
+                        retry_after=math.ceil(delay),
+                    ) from e
+                raise
+            print(f"Gemini call failed ({e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+def _generate_content_body(prompt: str) -> dict:
+    """Build a generateContent request body for a single user prompt."""
+    return {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+
+
+def _response_text(data: dict) -> str:
+    """Join the text parts of the first candidate in a generateContent response."""
+    candidates = data.get("candidates") or []
+    if not candidates:
+        return ""
+    parts = candidates[0].get("content", {}).get("parts", [])
+    return "".join(part.get("text", "") for part in parts)
+
+
+async def _call_gemini(client: httpx.AsyncClient, prompt: str) -> str:
+    """
+    Send a prompt to Gemini and return the full response text.
+
+    Args:
+        client: Shared Gemini API client
+        prompt: Prompt text to send
+
+    Returns:
+        Text of the Gemini response
+    """
+
+    async def send() -> bytes:
+        response = await client.post(
+            f"models/{GEMINI_MODEL}:generateContent",
+            json=_generate_content_body(prompt),
+        )
+        response.raise_for_status()
+        return response.content
+
+    return _response_text(orjson.loads(await _send_to_gemini(send)))
+
+
+async def _stream_gemini(client: httpx.AsyncClient, prompt: str) -> AsyncIterator[str]:
+    """
+    Send a prompt to Gemini and yield the response text as it is generated.
+
+    Only opening the stream is rate limited and retried; errors after the
+    first chunk propagate to the caller.
+
+    Args:
+        client: Shared Gemini API client
+        prompt: Prompt text to send
+
+    Yields:
+        Successive chunks of the response text
+    """
+
+    async def send() -> httpx.Response:
+        request = client.build_request(
+            "POST",
+            f"models/{GEMINI_MODEL}:streamGenerateContent",
+            params={"alt": "sse"},
+            json=_generate_content_body(prompt),
+        )
+        response = await client.send(request, stream=True)
+        if response.is_error:
+            await response.aread()
+            await response.aclose()
+            response.raise_for_status()
+        return response
+
+    response = await _send_to_gemini(send)
+    try:
+        # Server-sent events: each "data:" line holds a partial generateContent response
+        async for line in response.aiter_lines():
+            if line.startswith("data:"):
+                yield _response_text(orjson.loads(line[5:]))
+    finally:
+        await response.aclose()
 
 
 def parse_json_response(response_text: str) -> Optional[Any]:
@@ -129,22 +648,65 @@ def parse_json_response(response_text: str) -> Optional[Any]:
     if not response_text:
         return None
 
-    # Try to extract JSON from markdown code block
-    json_match = re.search(r"```(?:json)?\s*([\s\S]*?)\s*```", response_text)
-    if json_match:
-        json_str = json_match.group(1).strip()
-    else:
-        # Try parsing the raw response
-        json_str = response_text.strip()
+    # Common case: the response is bare JSON
+    json_str = response_text.strip()
+    try:
+        return orjson.loads(json_str)
+    except orjson.JSONDecodeError:
+        pass
+
+    # Otherwise extract JSON from the first markdown code block
+    fence_start = response_text.find("```")
+    if fence_start != -1:
+        content_start = fence_start + 3
+        if response_text.startswith("json", content_start):
+            content_start += 4
+        content_end = response_text.find("```", content_start)
+        if content_end == -1:
+            content_end = len(response_text)
+        json_str = response_text[content_start:content_end].strip()
 
     try:
-        return json.loads(json_str)
-    except json.JSONDecodeError as e:
+        return orjson.loads(json_str)
+    except orjson.JSONDecodeError as e:
         print(f"Failed to parse JSON response: {e}")
         print(f"Response text: {response_text[:500]}...")
         return None
 
 
+def _content_key(text: str) -> bytes:
+    """Hash text into a compact cache key."""
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+async def _single_flight(key: bytes, factory: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Run factory() at most once at a time per key.
+
+    Concurrent callers with the same key await the same task instead of
+    starting their own, so N identical requests make one upstream call.
+
+    Args:
+        key: Identifies identical work (e.g. a hash of the prompt input)
+        factory: Creates the coroutine to run when no call is in flight
+
+    Returns:
+        The result of the shared call
+    """
+    # Shield so one caller disconnecting does not cancel the call for the others
+    return await asyncio.shield(_inflight_task(key, factory))
+
+
+def _inflight_task(key: bytes, factory: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+    """Get the running task for key, starting factory() as one if there is none."""
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    return task
+
+
 def truncate_text(text: str, max_chars: int = MAX_TEXT_CHARS) -> str:
     """
     Truncate text to stay within token limits while keeping coherent content.
@@ -159,159 +721,393 @@ def truncate_text(text: str, max_chars: int = MAX_TEXT_CHARS) -> str:
     if len(text) <= max_chars:
         return text
 
-    # Truncate at a sentence boundary if possible
-    truncated = text[:max_chars]
-    last_period = truncated.rfind(".")
-    if last_period > max_chars * 0.8:  # Only use if reasonably close to limit
-        truncated = truncated[: last_period + 1]
+    # Truncate at a sentence boundary if one is reasonably close to the limit,
+    # searching only that window of the original text instead of copying it first
+    last_period = text.rfind(".", int(max_chars * 0.8) + 1, max_chars)
+    end = last_period + 1 if last_period != -1 else max_chars
 
-    return truncated + "\n\n[Content truncated for processing...]"
+    return text[:end] + "\n\n[Content truncated for processing...]"
 
 
-async def generate_flashcards_with_gemini(text: str) -> List[dict]:
+def _clean_flashcards(items: List[Any]) -> List[dict]:
     """
-    Generate 10 flashcards from the given text using Gemini AI.
+    Validate and clean flashcards returned by Gemini.
 
     Args:
-        text: The source text to generate flashcards from
+        items: Raw items parsed from the Gemini response
 
     Returns:
-        List of flashcard dictionaries with 'front' and 'back' keys
+        Up to 10 flashcard dictionaries with 'front' and 'back' keys
     """
-    model = get_gemini_model()
-    if not model:
-        raise ValueError(
-            "Gemini API key not configured. Set GEMINI_API_KEY in .env file."
-        )
+    flashcards = []
+    for item in items[:10]:  # Limit to 10
+        if isinstance(item, dict) and "front" in item and "back" in item:
+            flashcards.append(
+                {
+                    "front": str(item["front"]).strip(),
+                    "back": str(item["back"]).strip(),
+                }
+            )
+    return flashcards
 
-    # Truncate text to stay within limits
-    truncated_text = truncate_text(text)
 
-    prompt = f"""Based on the following text, generate exactly 10 flashcards for studying.
+def _clean_quiz_questions(items: List[Any]) -> List[dict]:
+    """
+    Validate and clean quiz questions returned by Gemini.
+
+    Args:
+        items: Raw items parsed from the Gemini response
+
+    Returns:
+        Up to 10 quiz question dictionaries with 'question', 'options', and 'correct_index'
+    """
+    questions = []
+    for item in items[:10]:  # Limit to 10
+        if (
+            isinstance(item, dict)
+            and "question" in item
+            and "options" in item
+            and "correct_index" in item
+            and isinstance(item["options"], list)
+            and len(item["options"]) == 4
+        ):
+            questions.append(
+                {
+                    "question": str(item["question"]).strip(),
+                    "options": [str(opt).strip() for opt in item["options"]],
+                    "correct_index": int(item["correct_index"]) % 4,
+                }
+            )
+    return questions
+
+
+def _study_materials_prompt(truncated_text: str) -> str:
+    """Build the prompt asking Gemini for flashcards and a quiz as one JSON object."""
+    return f"""Based on the following text, generate study materials: exactly 10 flashcards and exactly 10 multiple choice quiz questions.
 
 Each flashcard should have:
 - "front": A question, term, or concept (keep it concise)
 - "back": The answer, definition, or explanation
 
-Return ONLY a valid JSON array with no additional text. Example format:
-[
-  {{"front": "What is X?", "back": "X is..."}},
-  {{"front": "Define Y", "back": "Y means..."}}
-]
+Each quiz question should have:
+- "question": A clear question about the content
+- "options": An array of exactly 4 answer choices
+- "correct_index": The index (0-3) of the correct answer
+
+Return ONLY a valid JSON object with no additional text. Example format:
+{{
+  "flashcards": [
+    {{"front": "What is X?", "back": "X is..."}},
+    {{"front": "Define Y", "back": "Y means..."}}
+  ],
+  "quiz": [
+    {{
+      "question": "What is the main topic of X?",
+      "options": ["Option A", "Option B", "Option C", "Option D"],
+      "correct_index": 2
+    }}
+  ]
+}}
 
 TEXT TO STUDY:
 {truncated_text}
 
-Generate 10 flashcards as a JSON array:"""
+Generate the 10 flashcards and 10 quiz questions as a JSON object:"""
 
-    try:
-        response = await model.generate_content_async(prompt)
-        result = parse_json_response(response.text)
 
-        if not result or not isinstance(result, list):
-            raise ValueError("Invalid response format from Gemini")
-
-        # Validate and clean the flashcards
-        flashcards = []
-        for item in result[:10]:  # Limit to 10
-            if isinstance(item, dict) and "front" in item and "back" in item:
-                flashcards.append(
-                    {
-                        "front": str(item["front"]).strip(),
-                        "back": str(item["back"]).strip(),
-                    }
-                )
+def _validate_study_materials(result: Any) -> dict:
+    """
+    Validate and clean the study materials object returned by Gemini.
 
-        if len(flashcards) < 1:
-            raise ValueError("No valid flashcards generated")
+    Raises:
+        ValueError: If the response is malformed or either list ends up empty
+    """
+    if (
+        not isinstance(result, dict)
+        or not isinstance(result.get("flashcards"), list)
+        or not isinstance(result.get("quiz"), list)
+    ):
+        raise ValueError("Invalid response format from Gemini")
 
-        return flashcards
+    flashcards = _clean_flashcards(result["flashcards"])
+    if len(flashcards) < 1:
+        raise ValueError("No valid flashcards generated")
 
-    except Exception as e:
-        print(f"Error generating flashcards: {e}")
-        raise
+    questions = _clean_quiz_questions(result["quiz"])
+    if len(questions) < 1:
+        raise ValueError("No valid quiz questions generated")
 
+    return {"flashcards": flashcards, "quiz": questions}
 
-async def generate_quiz_with_gemini(text: str) -> List[dict]:
+
+async def generate_study_materials_with_gemini(text: str, fresh: bool = False) -> dict:
     """
-    Generate a 10-question multiple choice quiz from the given text using Gemini AI.
+    Generate 10 flashcards and a 10-question quiz from the given text in one call.
+
+    Results are reused for STUDY_MATERIALS_TTL_SECONDS, so loading flashcards
+    and then a quiz for the same documents costs a single generation.
+    Concurrent calls for the same text share one in-flight request.
 
     Args:
-        text: The source text to generate quiz questions from
+        text: The source text to generate study materials from
+        fresh: Skip the cached result and generate new materials, which then
+               replace it
 
     Returns:
-        List of quiz question dictionaries with 'question', 'options', and 'correct_index'
+        Dictionary with 'flashcards' and 'quiz' lists
+    """
+    key = _content_key(text)
+    cached = None if fresh else _study_materials_cache.get(key)
+    if cached:
+        return cached
+
+    return await _single_flight(key, lambda: _generate_study_materials(key, text))
+
+
+async def _generate_study_materials(
+    key: bytes, text: str, on_flashcard: Optional[Callable[[dict], None]] = None
+) -> dict:
+    """
+    Call Gemini for study materials and cache the validated result under key.
+
+    With on_flashcard, the reply is streamed and each flashcard is passed to
+    it as soon as it is complete.
     """
-    model = get_gemini_model()
-    if not model:
+    client = get_gemini_client()
+    if not client:
         raise ValueError(
             "Gemini API key not configured. Set GEMINI_API_KEY in .env file."
         )
 
     # Truncate text to stay within limits
-    truncated_text = truncate_text(text)
+    prompt = _study_materials_prompt(truncate_text(text))
 
-    prompt = f"""Based on the following text, generate exactly 10 multiple choice quiz questions.
+    try:
+        if on_flashcard is None:
+            response_text = await _call_gemini(client, prompt)
+        else:
+            response_text = await _stream_study_materials(client, prompt, on_flashcard)
+        materials = _validate_study_materials(parse_json_response(response_text))
+    except Exception as e:
+        print(f"Error generating study materials: {e}")
+        raise
 
-Each question should have:
-- "question": A clear question about the content
-- "options": An array of exactly 4 answer choices
-- "correct_index": The index (0-3) of the correct answer
+    _study_materials_cache[key] = materials
+    return materials
 
-Return ONLY a valid JSON array with no additional text. Example format:
-[
-  {{
-    "question": "What is the main topic of X?",
-    "options": ["Option A", "Option B", "Option C", "Option D"],
-    "correct_index": 2
-  }}
-]
 
-TEXT TO CREATE QUIZ FROM:
-{truncated_text}
+class _JsonItemScanner:
+    """
+    Incrementally finds complete JSON objects nested at a given depth.
 
-Generate 10 quiz questions as a JSON array:"""
+    Depth counts both objects and arrays, so each flashcard inside
+    {"flashcards": [{...}, ...]} is at depth 3. Used to pick items out of a
+    JSON document while it is still being streamed.
+    """
 
-    try:
-        response = await model.generate_content_async(prompt)
-        result = parse_json_response(response.text)
+    def __init__(self, item_depth: int):
+        self.item_depth = item_depth
+        self.buffer = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.item_start = -1
+
+    def feed(self, chunk: str) -> List[Any]:
+        """Add streamed text and return the items completed by it."""
+        self.buffer += chunk
+        items = []
+        for i in range(self.pos, len(self.buffer)):
+            ch = self.buffer[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+                if self.depth == self.item_depth and ch == "{":
+                    self.item_start = i
+            elif ch in "}]":
+                if self.depth == self.item_depth and self.item_start != -1:
+                    try:
+                        items.append(orjson.loads(self.buffer[self.item_start : i + 1]))
+                    except orjson.JSONDecodeError:
+                        pass
+                    self.item_start = -1
+                self.depth -= 1
+        self.pos = len(self.buffer)
+        return items
+
+
+async def _stream_study_materials(
+    client: httpx.AsyncClient, prompt: str, on_flashcard: Callable[[dict], None]
+) -> str:
+    """
+    Stream a study materials reply, passing on each flashcard as it completes.
 
-        if not result or not isinstance(result, list):
-            raise ValueError("Invalid response format from Gemini")
-
-        # Validate and clean the questions
-        questions = []
-        for item in result[:10]:  # Limit to 10
-            if (
-                isinstance(item, dict)
-                and "question" in item
-                and "options" in item
-                and "correct_index" in item
-                and isinstance(item["options"], list)
-                and len(item["options"]) == 4
-            ):
-                questions.append(
-                    {
-                        "question": str(item["question"]).strip(),
-                        "options": [str(opt).strip() for opt in item["options"]],
-                        "correct_index": int(item["correct_index"]) % 4,
-                    }
-                )
+    Returns:
+        The full reply text
+    """
+    # Items sit at depth 3: top-level object > "flashcards" array > flashcard
+    scanner = _JsonItemScanner(item_depth=3)
+    async for chunk_text in _stream_gemini(client, prompt):
+        for item in scanner.feed(chunk_text):
+            # Flashcards come first; quiz items fail this check and are skipped
+            for flashcard in _clean_flashcards([item]):
+                on_flashcard(flashcard)
+    return scanner.buffer
 
-        if len(questions) < 1:
-            raise ValueError("No valid quiz questions generated")
 
-        return questions
+class _FlashcardBroadcast:
+    """
+    Flashcards from one streaming generation, replayed to every listener.
 
-    except Exception as e:
-        print(f"Error generating quiz: {e}")
-        raise
+    The generation runs as its own task in _inflight, so streams that start
+    later join it, buffered callers await its result, and a listener that
+    disconnects does not stop it for the others.
+    """
+
+    def __init__(self):
+        self.flashcards: List[dict] = []
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def notify(self) -> None:
+        """Wake every listener waiting for a new card or the end of the stream."""
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, flashcard: dict) -> None:
+        """Add a flashcard from the stream, keeping at most 10."""
+        if len(self.flashcards) < 10:
+            self.flashcards.append(flashcard)
+            self.notify()
+
+    async def listen(self) -> AsyncIterator[dict]:
+        """Yield every flashcard published so far, then each new one as it arrives."""
+        sent = 0
+        while True:
+            if sent < len(self.flashcards):
+                yield self.flashcards[sent]
+                sent += 1
+            elif self.task.done():
+                break
+            else:
+                await self._changed.wait()
+
+        # A failure after the first card only cuts the stream short
+        error = None if self.task.cancelled() else self.task.exception()
+        if error is not None and sent == 0:
+            raise error
+
+
+async def stream_flashcards_with_gemini(
+    text: str, fresh: bool = False
+) -> AsyncIterator[dict]:
+    """
+    Generate up to 10 flashcards from the given text, yielding each as it arrives.
+
+    Streams the same combined prompt as generate_study_materials_with_gemini
+    and caches the full result when the stream completes, so a quiz request
+    for the same documents afterwards does not need another Gemini call.
+    Concurrent callers for the same text share one upstream stream.
+
+    Args:
+        text: The source text to generate flashcards from
+        fresh: Skip the cached result and start a new generation
+
+    Yields:
+        Flashcard dictionaries with 'front' and 'back' keys
+    """
+    key = _content_key(text)
+    cached = None if fresh else _study_materials_cache.get(key)
+    if cached:
+        for flashcard in cached["flashcards"]:
+            yield flashcard
+        return
+
+    broadcast = _flashcard_broadcasts.get(key)
+    if broadcast is None:
+        task = _inflight.get(key)
+        if task is not None:
+            # A buffered generation is already running; replay its result
+            materials = await asyncio.shield(task)
+            for flashcard in materials["flashcards"]:
+                yield flashcard
+            return
+
+        broadcast = _FlashcardBroadcast()
+        broadcast.task = _inflight_task(
+            key, lambda: _generate_study_materials(key, text, broadcast.publish)
+        )
+        _flashcard_broadcasts[key] = broadcast
+
+        def finished(_: asyncio.Task) -> None:
+            _flashcard_broadcasts.pop(key, None)
+            broadcast.notify()
+
+        broadcast.task.add_done_callback(finished)
+
+    async for flashcard in broadcast.listen():
+        yield flashcard
+
+
+async def generate_flashcards_with_gemini(text: str, fresh: bool = False) -> List[dict]:
+    """
+    Generate 10 flashcards from the given text using Gemini AI.
+
+    Args:
+        text: The source text to generate flashcards from
+        fresh: Skip the cached result and generate new flashcards
+
+    Returns:
+        List of flashcard dictionaries with 'front' and 'back' keys
+    """
+    materials = await generate_study_materials_with_gemini(text, fresh)
+    return materials["flashcards"]
+
+
+async def generate_quiz_with_gemini(text: str, fresh: bool = False) -> List[dict]:
+    """
+    Generate a 10-question multiple choice quiz from the given text using Gemini AI.
+
+    Args:
+        text: The source text to generate quiz questions from
+        fresh: Skip the cached result and generate a new quiz
+
+    Returns:
+        List of quiz question dictionaries with 'question', 'options', and 'correct_index'
+    """
+    materials = await generate_study_materials_with_gemini(text, fresh)
+    return materials["quiz"]
+
+
+def _fallback_grade(ctx: dict) -> dict:
+    """Grade one answer locally, without AI feedback."""
+    return {
+        "question_index": ctx["question_index"],
+        "is_correct": ctx["is_correct"],
+        "feedback": (
+            "Correct!"
+            if ctx["is_correct"]
+            else f"Incorrect. The correct answer was: {ctx['correct_answer']}"
+        ),
+    }
 
 
 async def grade_quiz_with_gemini(answers: List[dict]) -> List[dict]:
     """
     Grade quiz answers and provide AI-generated feedback for each question.
 
+    All answers are graded in one Gemini call, and identical submissions
+    arriving together share that call.
+
     Args:
         answers: List of answer dicts with 'question', 'options', 'correct_index',
                  'selected_index', and 'question_index'
@@ -319,8 +1115,8 @@ async def grade_quiz_with_gemini(answers: List[dict]) -> List[dict]:
     Returns:
         List of graded answer dicts with 'question_index', 'is_correct', and 'feedback'
     """
-    model = get_gemini_model()
-    if not model:
+    client = get_gemini_client()
+    if not client:
         raise ValueError(
             "Gemini API key not configured. Set GEMINI_API_KEY in .env file."
         )
@@ -341,13 +1137,24 @@ async def grade_quiz_with_gemini(answers: List[dict]) -> List[dict]:
             }
         )
 
+    context_json = orjson.dumps(grading_context, option=orjson.OPT_INDENT_2).decode()
+    key = _content_key("grade\n" + context_json)
+    return await _single_flight(
+        key, lambda: _grade_quiz(client, grading_context, context_json)
+    )
+
+
+async def _grade_quiz(
+    client: httpx.AsyncClient, grading_context: List[dict], context_json: str
+) -> List[dict]:
+    """Ask Gemini for feedback on every answer at once, falling back locally."""
     prompt = f"""You are grading a quiz. For each question, provide brief, helpful feedback.
 
 For correct answers: Acknowledge correctness and optionally add a reinforcing fact.
 For incorrect answers: Explain why the correct answer is right (1-2 sentences max).
 
 Quiz answers to grade:
-{json.dumps(grading_context, indent=2)}
+{context_json}
 
 Return ONLY a valid JSON array with feedback for each question. Example format:
 [
@@ -358,72 +1165,40 @@ Return ONLY a valid JSON array with feedback for each question. Example format:
 Generate feedback as a JSON array:"""
 
     try:
-        response = await model.generate_content_async(prompt)
-        result = parse_json_response(response.text)
+        response_text = await _call_gemini(client, prompt)
+        result = parse_json_response(response_text)
 
         if not result or not isinstance(result, list):
             # Fallback: generate basic feedback without AI
-            return [
-                {
-                    "question_index": ctx["question_index"],
-                    "is_correct": ctx["is_correct"],
-                    "feedback": (
-                        "Correct!"
-                        if ctx["is_correct"]
-                        else f"Incorrect. The correct answer was: {ctx['correct_answer']}"
-                    ),
-                }
-                for ctx in grading_context
-            ]
+            return [_fallback_grade(ctx) for ctx in grading_context]
 
-        # Validate and clean the feedback
-        graded = []
+        # Keep one feedback entry per submitted question; correctness is
+        # already known locally, so only the feedback text is taken from the AI
+        by_index = {ctx["question_index"]: ctx for ctx in grading_context}
+        graded = {}
         for item in result:
-            if (
-                isinstance(item, dict)
-                and "question_index" in item
-                and "is_correct" in item
-                and "feedback" in item
-            ):
-                graded.append(
-                    {
-                        "question_index": int(item["question_index"]),
-                        "is_correct": bool(item["is_correct"]),
-                        "feedback": str(item["feedback"]).strip(),
-                    }
-                )
+            if not (isinstance(item, dict) and "feedback" in item):
+                continue
+            try:
+                index = int(item["question_index"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if index in by_index and index not in graded:
+                graded[index] = {
+                    "question_index": index,
+                    "is_correct": by_index[index]["is_correct"],
+                    "feedback": str(item["feedback"]).strip(),
+                }
 
         # If AI response is incomplete, fill in missing with fallback
-        if len(graded) < len(answers):
-            existing_indices = {g["question_index"] for g in graded}
-            for ctx in grading_context:
-                if ctx["question_index"] not in existing_indices:
-                    graded.append(
-                        {
-                            "question_index": ctx["question_index"],
-                            "is_correct": ctx["is_correct"],
-                            "feedback": (
-                                "Correct!"
-                                if ctx["is_correct"]
-                                else f"Incorrect. The correct answer was: {ctx['correct_answer']}"
-                            ),
-                        }
-                    )
-
-        return sorted(graded, key=lambda x: x["question_index"])
+        if len(graded) < len(by_index):
+            for index, ctx in by_index.items():
+                if index not in graded:
+                    graded[index] = _fallback_grade(ctx)
+
+        return sorted(graded.values(), key=lambda x: x["question_index"])
 
     except Exception as e:
         print(f"Error grading quiz: {e}")
         # Fallback grading without AI feedback
-        return [
-            {
-                "question_index": ctx["question_index"],
-                "is_correct": ctx["is_correct"],
-                "feedback": (
-                    "Correct!"
-                    if ctx["is_correct"]
-                    else f"Incorrect. The correct answer was: {ctx['correct_answer']}"
-                ),
-            }
-            for ctx in grading_context
-        ]
+        return [_fallback_grade(ctx) for ctx in grading_context]
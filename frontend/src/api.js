@@ -29,12 +29,45 @@ export async function fetchFlashcards() {
     return response.json();
 }
 
+/**
+ * Stream generated flashcards, calling onCard as each one arrives.
+ * @param {(card: {front: string, back: string}) => void} onCard
+ * @returns {Promise<void>}
+ */
+export async function streamFlashcards(onCard) {
+    const response = await fetch(`${API_BASE}/flashcards/stream`);
+    if (!response.ok) {
+        throw new Error(`Failed to fetch flashcards: ${response.statusText}`);
+    }
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) {
+            break;
+        }
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split("\n");
+        buffer = lines.pop();
+        for (const line of lines) {
+            if (line.trim()) {
+                onCard(JSON.parse(line));
+            }
+        }
+    }
+    if (buffer.trim()) {
+        onCard(JSON.parse(buffer));
+    }
+}
+
 /**
  * Fetch generated quiz from PDF content.
+ * @param {{fresh?: boolean}} [options] - fresh: generate a new quiz instead of reusing the cached one
  * @returns {Promise<Array<{question: string, options: string[], correct_index: number}>>}
  */
-export async function fetchQuiz() {
-    const response = await fetch(`${API_BASE}/quiz`);
+export async function fetchQuiz({ fresh = false } = {}) {
+    const response = await fetch(`${API_BASE}/quiz${fresh ? "?fresh=1" : ""}`);
     if (!response.ok) {
         throw new Error(`Failed to fetch quiz: ${response.statusText}`);
     }
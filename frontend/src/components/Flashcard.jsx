@@ -5,7 +5,7 @@
 
 import { useEffect, useState, useCallback } from "react";
 import { ChevronLeft, ChevronRight, RotateCcw, Loader2 } from "lucide-react";
-import { fetchFlashcards } from "../api";
+import { streamFlashcards } from "../api";
 
 function Flashcard() {
     const [cards, setCards] = useState([]);
@@ -22,11 +22,15 @@ function Flashcard() {
     const loadFlashcards = async () => {
         setIsLoading(true);
         setError(null);
+        setCards([]);
+        setCurrentIndex(0);
+        setIsFlipped(false);
         try {
-            const data = await fetchFlashcards();
-            setCards(data);
-            setCurrentIndex(0);
-            setIsFlipped(false);
+            // Show the first card as soon as it arrives; the rest append as they stream in
+            await streamFlashcards((card) => {
+                setCards((prev) => [...prev, card]);
+                setIsLoading(false);
+            });
         } catch (err) {
             setError(err.message || "Failed to generate flashcards");
         } finally {
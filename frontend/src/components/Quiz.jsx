@@ -27,13 +27,13 @@ function Quiz() {
         loadQuiz();
     }, []);
 
-    const loadQuiz = async () => {
+    const loadQuiz = async ({ fresh = false } = {}) => {
         setIsLoading(true);
         setError(null);
         setResults(null);
         setAnswers({});
         try {
-            const data = await fetchQuiz();
+            const data = await fetchQuiz({ fresh });
             setQuestions(data);
         } catch (err) {
             setError(err.message || "Failed to generate quiz");
@@ -142,7 +142,7 @@ function Quiz() {
                         </span>
                     </p>
                     <button
-                        onClick={loadQuiz}
+                        onClick={() => loadQuiz({ fresh: true })}
                         className="btn-primary inline-flex items-center gap-2 text-sm sm:text-base"
                     >
                         <RotateCcw className="w-4 h-4" />